@@ -2,14 +2,16 @@
 # - Wind: Open-Meteo (auto model selection for Québec)
 # - Tides: SPINE baseline near Baie de Beauport; other spots = time-shifted estimates
 # - Rules: gusts >= 10 kn + spot-specific direction + tide
-# - Output: forecast.json consumed by index.html
+# - Output: forecast.json consumed by index.html (+ forecast.ndjson, one hour row per line)
 
-import json, datetime as dt, urllib.request, urllib.parse, sys, time, bisect
+import json, datetime as dt, urllib.error, urllib.parse, http.client, sys, time, os, hashlib, threading, gzip, zlib, random, email.utils
 from zoneinfo import ZoneInfo
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ----- CONFIG -----
 TZ = ZoneInfo("America/Toronto")
+UTC = dt.timezone.utc
 NOW = dt.datetime.now(TZ).replace(minute=0, second=0, microsecond=0)
 HOURS = 168  # forecast horizon (hours) -> 7 days
 
@@ -26,20 +28,32 @@ THRESHOLD_GUST = {k: 10.0 for k in SPOTS.keys()}
 # Direction sectors (deg, FROM)
 DIR_SW = (200, 250)  # Ste-Anne / Ange-Gardien
 DIR_NE = (30, 70)    # St-Jean
-def _in_sector(deg, lo, hi): return (lo <= deg <= hi) if lo <= hi else (deg >= lo or deg <= hi)
+def _in_sector(deg, lo, hi): return (deg - lo) % 360 <= (hi - lo) % 360  # one compare, wrap-safe
 def in_SW(deg): return _in_sector(deg, *DIR_SW)
 def in_NE(deg): return _in_sector(deg, *DIR_NE)
+# Go rules per spot: (direction test or None for any direction, required tide or None for any tide)
+SPOT_RULES = {
+    "beauport":     (None,  None),
+    "ste_anne":     (in_SW, "rising"),
+    "st_jean":      (in_NE, "falling"),
+    "ange_gardien": (in_SW, "rising"),
+}
 
 # SPINE water level API (DFO)
 SPINE_BASE = "https://api-spine.azure.cloud-nuage.dfo-mpo.gc.ca/rest/v1/waterLevel"
-
-# Candidate points around Beauport (pick the one returning most data)
-BASELINE_CANDIDATES = [
+SPINE_MAX_WORKERS = 6       # max concurrent chunk requests per batch
+SPINE_MAX_URL = 4000        # chars per request URL (~70 instants); a 414 halves the chunk and retries
+
+# Candidate points around Beauport: the first (or the previous run's selection) is fetched over the
+# full horizon right away; the others are only probed when it returns less than
+# BASELINE_MIN_COVERAGE of the instants
+BASELINE_MIN_COVERAGE = 0.9
+BASELINE_CANDIDATES = (
     (46.8609, -71.1835),
     (46.8420, -71.2100),
     (46.8750, -71.1600),
     (46.8350, -71.2450),
-]
+)
 
 # Tide classification tuning
 EPS_TIDE = 0.02             # meters; delta to call rising/falling vs slack
@@ -53,81 +67,369 @@ TIDE_PHASE_OFFSETS = {
     "ange_gardien": {"rising": 23, "falling": 10},  # same as Ste-Anne
 }
 
+# On-disk response cache (the workflow carries .cache/ between runs): reruns inside the TTL skip the network
+CACHE_DIR = ".cache"
+WIND_CACHE_TTL = 1800       # s; Open-Meteo refreshes hourly
+TIDE_CACHE_TTL = 21600      # s; SPINE predictions are stable for hours
+# Per-instant SPINE levels (keyed by station, then UTC instant): chunk URLs change as the horizon
+# slides every hour, but most instants were already fetched by the previous run
+LEVEL_CACHE_PATH = os.path.join(CACHE_DIR, "spine_levels.json")
+LEVEL_CACHE_TTL = 86400     # s
+BASELINE_STATE_PATH = os.path.join(CACHE_DIR, "spine_baseline.json")  # last selected candidate
+RESPONSE_CACHE_MAX_AGE = 86400  # s; response entries unused this long are deleted (URLs move with the horizon)
+
 # ----- HTTP helper -----
-def http_get_json(url, timeout=45):
-    with urllib.request.urlopen(url, timeout=timeout) as r:
-        return json.load(r)
+# Keep-alive: idle connections are pooled per (scheme, host) and reused across calls and threads,
+# so the many SPINE chunk requests pay for TCP+TLS setup once per connection, not once per request.
+POOL_MAX_PER_HOST = 8       # max in-flight requests (hence open connections) per host
+HTTP_HEADERS = {"Accept-Encoding": "gzip, deflate", "User-Agent": "wingfoil-windows-quebec/1.0"}
+HTTP_RETRIES = 2            # extra attempts on transient failures (network errors, 429, 5xx)
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+_HOST_SLOTS = {}
+
+def _host_slots(scheme, host):
+    with _POOL_LOCK:
+        sem = _HOST_SLOTS.get((scheme, host))
+        if sem is None:
+            sem = _HOST_SLOTS[(scheme, host)] = threading.BoundedSemaphore(POOL_MAX_PER_HOST)
+        return sem
+
+def _acquire_conn(scheme, host, timeout):
+    with _POOL_LOCK:
+        idle = _POOL.get((scheme, host))
+        if idle:
+            return idle.pop(), True
+    cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    return cls(host, timeout=timeout), False
+
+def _release_conn(scheme, host, conn):
+    with _POOL_LOCK:
+        _POOL.setdefault((scheme, host), []).append(conn)
+
+def http_request(url, timeout=45, headers=None):
+    """GET over a pooled connection -> (response, decoded body); any status is returned as-is."""
+    u = urllib.parse.urlsplit(url)
+    target = f"{u.path or '/'}?{u.query}" if u.query else (u.path or "/")
+    with _host_slots(u.scheme, u.netloc):
+        while True:
+            conn, reused = _acquire_conn(u.scheme, u.netloc, timeout)
+            try:
+                conn.request("GET", target, headers={**HTTP_HEADERS, **(headers or {})})
+                r = conn.getresponse()
+                body = r.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue  # server dropped an idle keep-alive socket: retry on another one
+                raise
+            if r.will_close:
+                conn.close()
+            else:
+                _release_conn(u.scheme, u.netloc, conn)
+            break
+    encoding = r.getheader("Content-Encoding", "").lower()
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "deflate":
+        try:
+            body = zlib.decompress(body)                   # RFC 9110: zlib-wrapped
+        except zlib.error:
+            body = zlib.decompress(body, -zlib.MAX_WBITS)  # some servers send raw deflate
+    return r, body
+
+def retry_after_seconds(err):
+    """Delay asked for by a Retry-After header on an HTTPError (seconds or HTTP-date), else None."""
+    value = err.headers.get("Retry-After") if isinstance(err, urllib.error.HTTPError) and err.headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - dt.datetime.now(UTC)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+def _write_cache(path, obj):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def prune_response_cache():
+    """Delete response cache entries (body + validators) not used within RESPONSE_CACHE_MAX_AGE."""
+    keep = {LEVEL_CACHE_PATH, BASELINE_STATE_PATH}
+    cutoff = time.time() - RESPONSE_CACHE_MAX_AGE
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        if not name.endswith(".json") or path in keep:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                meta_path = os.path.splitext(path)[0] + ".meta"
+                if os.path.exists(meta_path):
+                    os.remove(meta_path)
+        except OSError:
+            pass
+
+def _is_transient(err) -> bool:
+    """Worth retrying: network/protocol errors, throttling (429) and server errors (5xx)."""
+    if isinstance(err, urllib.error.HTTPError):
+        return err.code == 429 or err.code >= 500
+    return isinstance(err, (OSError, http.client.HTTPException))
+
+def backoff_delay(tries, err, pause=0.2, max_pause=5.0, max_retry_after=30.0):
+    """Exponential backoff + jitter so concurrent requests don't retry in lockstep; a throttled
+    response (429/503) may ask for longer via Retry-After (capped)."""
+    delay = min(pause * 2 ** (tries - 1) + random.uniform(0, pause), max_pause)
+    wait = retry_after_seconds(err)
+    if wait is not None:
+        delay = min(max(delay, wait), max_retry_after)
+    return delay
+
+def http_get_json(url, timeout=45, ttl=0, retries=HTTP_RETRIES):
+    path = _cache_path(url) if ttl > 0 else None
+    meta_path = os.path.splitext(path)[0] + ".meta" if path else None
+    cached, validators = None, {}
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if time.time() - os.path.getmtime(path) < ttl:
+                return cached
+            with open(meta_path, encoding="utf-8") as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            pass  # missing/corrupt entry or no validators -> plain GET
+    # Expired entry with an ETag/Last-Modified: revalidate, and reuse the body on 304
+    cond = {}
+    if cached is not None and validators.get("etag"):
+        cond["If-None-Match"] = validators["etag"]
+    if cached is not None and validators.get("last_modified"):
+        cond["If-Modified-Since"] = validators["last_modified"]
+    tries = 0
+    while True:
+        try:
+            r, body = http_request(url, timeout=timeout, headers=cond)
+            if r.status != 200 and not (r.status == 304 and cond):
+                raise urllib.error.HTTPError(url, r.status, r.reason, r.headers, None)
+            break
+        except Exception as e:
+            tries += 1
+            if tries > retries or not _is_transient(e):
+                raise
+            time.sleep(backoff_delay(tries, e))  # host slot is released while waiting
+    if r.status == 304:
+        try:
+            os.utime(path)  # fresh for another ttl
+        except OSError:
+            pass
+        return cached
+    data = json.loads(body)
+    if path:
+        try:
+            _write_cache(path, data)
+            meta = {"etag": r.getheader("ETag"), "last_modified": r.getheader("Last-Modified")}
+            if any(meta.values()):
+                _write_cache(meta_path, meta)
+            elif os.path.exists(meta_path):
+                os.remove(meta_path)
+        except OSError as e:
+            print(f"[WARN] Cache write failed for {url}: {e}", file=sys.stderr)
+    return data
 
 # ----- Wind (Open-Meteo) -----
-def fetch_open_meteo_wind(lat, lon, start_dt, end_dt):
-    base = "https://api.open-meteo.com/v1/forecast"
-    qs = urllib.parse.urlencode({
-        "latitude": lat,
-        "longitude": lon,
-        "hourly": "windspeed_10m,windgusts_10m,winddirection_10m",
-        "wind_speed_unit": "kn",
-        "timezone": "America/Toronto",
-        "start_date": start_dt.date().isoformat(),
-        "end_date": end_dt.date().isoformat(),
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+_WIND_QS = urllib.parse.urlencode({  # constant part of the query, encoded once
+    "hourly": "windspeed_10m,windgusts_10m,winddirection_10m",
+    "wind_speed_unit": "kn",
+    "timezone": "America/Toronto",
+})
+
+def fetch_open_meteo_wind(coords, start_date, end_date):
+    """Hourly wind for one or more (lat, lon) points in a single request -> one block per point, in order.
+    start_date/end_date are local ISO dates ("YYYY-MM-DD")."""
+    where = urllib.parse.urlencode({
+        "latitude": ",".join(f"{lat}" for lat, _ in coords),
+        "longitude": ",".join(f"{lon}" for _, lon in coords),
     })
-    return http_get_json(f"{base}?{qs}")
+    when = f"start_date={start_date}&end_date={end_date}"
+    data = http_get_json(f"{OPEN_METEO_URL}?{where}&{_WIND_QS}&{when}", ttl=WIND_CACHE_TTL)
+    return data if isinstance(data, list) else [data]  # a single location comes back as a bare object
+
+def expected_utc_grid(start_dt, end_dt):
+    """UTC instants spanned by Open-Meteo's hourly timeline for these dates (local midnight of the
+    start date through midnight after the end date, inclusive), as SPINE 'Z' strings."""
+    t0 = dt.datetime.combine(start_dt.date(), dt.time(), TZ).astimezone(UTC)
+    t1 = dt.datetime.combine(end_dt.date() + dt.timedelta(days=1), dt.time(), TZ).astimezone(UTC)
+    n = int((t1 - t0).total_seconds()) // 3600
+    return [(t0 + dt.timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ") for i in range(n + 1)]
 
 # ----- SPINE water levels (batched) -----
-def spine_levels_batch(lat, lon, utc_list, chunk_size=36, pause=0.2, max_retries=2):
-    out, n = {}, len(utc_list)
-    for i in range(0, n, chunk_size):
-        chunk = utc_list[i:i+chunk_size]
-        q = []
-        for t in chunk:
-            q += [("lat", f"{lat}"), ("lon", f"{lon}"), ("t", t)]
-        url = f"{SPINE_BASE}?{urllib.parse.urlencode(q)}"
-        tries = 0
-        while True:
-            try:
-                data = http_get_json(url)
-                items = data.get("responseItems", [])
-                ok = other = 0
-                for it in items:
-                    if it.get("status") == "OK":
-                        inst = it.get("instant"); wl = it.get("waterLevel")
-                        if inst is not None and wl is not None:
-                            out[inst] = wl; ok += 1
-                    else:
-                        other += 1
-                print(f"[INFO] SPINE chunk {i//chunk_size+1}: {ok}/{len(chunk)} OK (+{other} non-OK) @({lat},{lon})", file=sys.stderr)
-                break
-            except Exception as e:
-                tries += 1
-                if tries > max_retries:
-                    print(f"[WARN] SPINE chunk failed after retries: {e}", file=sys.stderr)
-                    break
-                time.sleep(pause)
+def spine_levels_batch(lat, lon, utc_list, max_url_len=SPINE_MAX_URL, max_retries=HTTP_RETRIES, max_workers=SPINE_MAX_WORKERS):
+    # Pack (lat, lon, t) triples into as few URLs as fit the length budget. SPINE wants lat/lon
+    # repeated per triple, but they are constant for the call: encode that part once.
+    where = urllib.parse.urlencode([("lat", f"{lat}"), ("lon", f"{lon}")])
+    triples = [f"{where}&t={urllib.parse.quote(t, safe='')}" for t in utc_list]
+    chunks, cur, size = [], [], len(SPINE_BASE) + 1
+    for q in triples:
+        if cur and size + len(q) + 1 > max_url_len:
+            chunks.append(cur); cur, size = [], len(SPINE_BASE) + 1
+        cur.append(q); size += len(q) + 1
+    if cur: chunks.append(cur)
+    if not chunks: return {}
+
+    def fetch_chunk(n, chunk):
+        url = f"{SPINE_BASE}?{'&'.join(chunk)}"
+        try:
+            data = http_get_json(url, ttl=TIDE_CACHE_TTL, retries=max_retries)
+        except urllib.error.HTTPError as e:
+            if e.code == 414 and len(chunk) > 1:
+                # URL still too long for the server: split and fetch both halves
+                print(f"[INFO] SPINE chunk {n}: URL too long ({len(url)} chars), splitting", file=sys.stderr)
+                half = len(chunk) // 2
+                return {**fetch_chunk(n, chunk[:half]), **fetch_chunk(n, chunk[half:])}
+            print(f"[WARN] SPINE chunk {n} failed: {e}", file=sys.stderr)
+            return {}
+        except Exception as e:
+            print(f"[WARN] SPINE chunk {n} failed: {e}", file=sys.stderr)
+            return {}
+        got, ok, other = {}, 0, 0
+        for it in data.get("responseItems", []) if isinstance(data, dict) else []:
+            if it.get("status") == "OK":
+                inst = it.get("instant"); wl = it.get("waterLevel")
+                if inst is not None and wl is not None:
+                    got[inst] = wl; ok += 1
+            else:
+                other += 1
+        print(f"[INFO] SPINE chunk {n}: {ok}/{len(chunk)} OK (+{other} non-OK) @({lat},{lon})", file=sys.stderr)
+        return got
+
+    # Chunks are independent: fire them concurrently (bounded to stay polite with SPINE)
+    out = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+        for got in pool.map(fetch_chunk, range(1, len(chunks)+1), chunks):
+            out.update(got)
     return out
 
+_LEVELS = None              # {"lat,lon": {instant: [level, fetched_at]}}, loaded on first use
+_LEVELS_LOCK = threading.Lock()
+
+def _level_cache():
+    global _LEVELS
+    if _LEVELS is None:
+        try:
+            with open(LEVEL_CACHE_PATH, encoding="utf-8") as f:
+                _LEVELS = json.load(f)
+        except (OSError, ValueError):
+            _LEVELS = {}
+    return _LEVELS
+
+def spine_levels(lat, lon, utc_list, **kw):
+    """spine_levels_batch() behind the per-instant level cache: only uncached instants hit SPINE."""
+    key, now = f"{lat},{lon}", time.time()
+    with _LEVELS_LOCK:
+        known = {ts: e[0] for ts, e in _level_cache().get(key, {}).items() if now - e[1] < LEVEL_CACHE_TTL}
+    hits = {ts: known[ts] for ts in utc_list if ts in known}
+    missing = [ts for ts in utc_list if ts not in known]
+    fresh = spine_levels_batch(lat, lon, missing, **kw) if missing else {}
+    if fresh:
+        with _LEVELS_LOCK:
+            _level_cache().setdefault(key, {}).update({ts: [v, now] for ts, v in fresh.items()})
+    if hits:
+        print(f"[INFO] SPINE level cache: {len(hits)}/{len(utc_list)} instants @({lat},{lon})", file=sys.stderr)
+    return {**hits, **fresh}
+
+def save_level_cache():
+    if _LEVELS is None:
+        return
+    now = time.time()
+    with _LEVELS_LOCK:
+        live = {key: {ts: e for ts, e in levels.items() if now - e[1] < LEVEL_CACHE_TTL}
+                for key, levels in _LEVELS.items()}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(LEVEL_CACHE_PATH + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({key: levels for key, levels in live.items() if levels}, f, separators=(",", ":"))
+        os.replace(LEVEL_CACHE_PATH + ".tmp", LEVEL_CACHE_PATH)
+    except OSError as e:
+        print(f"[WARN] Level cache write failed: {e}", file=sys.stderr)
+
+def baseline_candidates():
+    """BASELINE_CANDIDATES with the last selected point (if still listed) moved to the front."""
+    try:
+        with open(BASELINE_STATE_PATH, encoding="utf-8") as f:
+            last = tuple(json.load(f))
+    except (OSError, ValueError, TypeError):
+        return BASELINE_CANDIDATES
+    return sorted(BASELINE_CANDIDATES, key=lambda c: c != last)  # stable: the rest keep their order
+
+def remember_baseline(latlon):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(BASELINE_STATE_PATH + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(list(latlon), f)
+        os.replace(BASELINE_STATE_PATH + ".tmp", BASELINE_STATE_PATH)
+    except OSError as e:
+        print(f"[WARN] Baseline state write failed: {e}", file=sys.stderr)
+
+# fromisoformat() accepts a trailing "Z" natively from Python 3.11
+if sys.version_info >= (3, 11):
+    def parse_utc_iso(ts: str) -> dt.datetime:
+        return dt.datetime.fromisoformat(ts)
+else:
+    def parse_utc_iso(ts: str) -> dt.datetime:
+        return dt.datetime.fromisoformat(ts.replace("Z", "+00:00"))
+
 def build_sorted_series(spine_map):
     times, vals = [], []
     for ts, v in spine_map.items():
         try:
-            t = dt.datetime.fromisoformat(ts.replace("Z","+00:00")).astimezone(dt.timezone.utc)
+            t = parse_utc_iso(ts).astimezone(UTC)
             times.append(t); vals.append(float(v))
         except Exception:
             continue
     order = sorted(range(len(times)), key=lambda i: times[i])
     return [times[i] for i in order], [vals[i] for i in order]
 
-def nearest_value(times, vals, target_dt_utc, max_minutes):
-    if not times: return None
-    i = bisect.bisect_left(times, target_dt_utc)
-    cand = []
-    if i < len(times): cand.append(i)
-    if i > 0: cand.append(i-1)
-    best = None; best_dt = None
-    for idx in cand:
-        dt_i = times[idx]
-        if abs((dt_i - target_dt_utc).total_seconds()) <= max_minutes*60:
-            if best is None or abs((dt_i - target_dt_utc).total_seconds()) < abs((best_dt - target_dt_utc).total_seconds()):
-                best = vals[idx]; best_dt = dt_i
-    return best
+def resolve_levels(spine_map, instants, instants_dt):
+    """Water level per UTC ISO instant (ascending, with matching aware datetimes): exact hit, then
+    nearest within MAX_T_MATCH_MIN, then EDGE_MAX_MINUTES. The instants are sorted, so a single
+    forward walk over the series finds each insertion point."""
+    times, vals = build_sorted_series(spine_map)
+    out, j, n = [], 0, len(times)
+    for ts, t in zip(instants, instants_dt):
+        v = spine_map.get(ts)
+        if v is None and times:
+            while j < n and times[j] < t:
+                j += 1
+            # Closer of the two neighbours (ties go to the later sample)
+            if j == n:   k = j - 1
+            elif j == 0: k = 0
+            else:        k = j if times[j] - t <= t - times[j-1] else j - 1
+            # The nearest sample is the answer in either window; the wide one only extends the reach
+            if abs((times[k] - t).total_seconds()) <= max(MAX_T_MATCH_MIN, EDGE_MAX_MINUTES)*60:
+                v = vals[k]
+        out.append(v)
+    return out
+
+def classify_trend(v0, v1) -> str:
+    if v0 is None or v1 is None:
+        return "unknown"
+    dv = v1 - v0
+    if dv > EPS_TIDE:  return "rising"
+    if dv < -EPS_TIDE: return "falling"
+    return "slack"
 
 # ----- Helpers for local-time handling -----
 def parse_local_iso(s: str) -> dt.datetime | None:
@@ -136,210 +438,251 @@ def parse_local_iso(s: str) -> dt.datetime | None:
     except Exception:
         return None
 
-def round_to_local_hour(t: dt.datetime) -> dt.datetime:
-    if t.minute >= 30:
-        t = t + dt.timedelta(hours=1)
-    return t.replace(minute=0, second=0, microsecond=0, tzinfo=TZ)
-
 # ----- Apply CHS offsets in LOCAL time -----
-def apply_spot_tide_offsets(out_data: dict):
+def hour_shift(offset_min: int) -> int:
+    """Whole hours to look back for an offset in minutes (nearest hour, :30 rounds up)."""
+    return (offset_min + 29) // 60
+
+def shift_spot_tides(base: list) -> dict:
     """
-    Use Beauport tide phase as baseline in LOCAL time and synthesize tide phase for
-    Sainte-Anne, St-Jean, Ange-Gardien by applying CHS-style time offsets (minutes).
+    Use Beauport tide phase (one entry per hourly row) as baseline in LOCAL time and synthesize
+    tide phase for Sainte-Anne, St-Jean, Ange-Gardien by applying CHS-style time offsets (minutes).
+    Rows sit on a uniform hourly grid, so each offset is a constant row shift.
     """
-    hours = out_data.get("hours", [])
-    if not hours: return
-
-    # Build local-time map: 'YYYY-MM-DDTHH:00' -> Beauport tide
-    base_local = {}
-    for row in hours:
-        t_str = row.get("time")
-        if not t_str: continue
-        tide = (row.get("beauport") or {}).get("tide", "unknown")
-        base_local[t_str] = tide
-
-    def probe_local(local_dt: dt.datetime) -> str:
-        key = round_to_local_hour(local_dt).replace(tzinfo=None).isoformat(timespec="minutes")
-        if len(key) == 16:
-            return base_local.get(key, "unknown")
-        key2 = f"{local_dt.year:04d}-{local_dt.month:02d}-{local_dt.day:02d}T{local_dt.hour:02d}:00"
-        return base_local.get(key2, "unknown")
-
-    def shifted_state_local(t_local: dt.datetime, off_rise_min: int, off_fall_min: int) -> str:
-        tr = probe_local(t_local - dt.timedelta(minutes=off_rise_min))
-        tf = probe_local(t_local - dt.timedelta(minutes=off_fall_min))
+    n = len(base)
+
+    def probe(i: int) -> str:
+        return base[i] if 0 <= i < n else "unknown"
+
+    def shifted_state(i: int, shift_rise: int, shift_fall: int) -> str:
+        tr = probe(i - shift_rise)
+        tf = probe(i - shift_fall)
         if tr == "rising":  return "rising"
         if tf == "falling": return "falling"
         if "slack" in (tr, tf): return "slack"
         return tr if tr != "unknown" else tf
 
-    for row in hours:
-        t_local = parse_local_iso(row.get("time",""))
-        if not t_local: continue
-        for spot_key, offs in TIDE_PHASE_OFFSETS.items():
-            spot = (row.get(spot_key) or {})
-            spot["tide"] = shifted_state_local(t_local, offs["rising"], offs["falling"])
-            row[spot_key] = spot
-
-# ----- Rule evaluation (used twice) -----
-def evaluate_go(spot_key: str, gust_kn, dir_deg, tide_state: str) -> bool:
-    thr = THRESHOLD_GUST[spot_key]
-    if gust_kn is None or gust_kn < thr: 
-        return False
-    if spot_key == "beauport":
-        return True  # any direction
-    if dir_deg is None:
+    out = {}
+    for spot_key, offs in TIDE_PHASE_OFFSETS.items():
+        shift_rise, shift_fall = hour_shift(offs["rising"]), hour_shift(offs["falling"])
+        out[spot_key] = [shifted_state(i, shift_rise, shift_fall) for i in range(n)]
+    return out
+
+# ----- Rule evaluation -----
+def sector_mask(spot_key: str, dirs: list) -> list:
+    """Per-hour membership of the wind direction in the spot's sector (missing direction -> False)."""
+    test = SPOT_RULES.get(spot_key, (None, None))[0]
+    if test is None:
+        return [True] * len(dirs)
+    return [d is not None and test(d) for d in dirs]
+
+def evaluate_go(spot_key: str, gust_kn, dir_ok: bool, tide_state: str) -> bool:
+    rule = SPOT_RULES.get(spot_key)
+    if rule is None or gust_kn is None or gust_kn < THRESHOLD_GUST[spot_key]:
         return False
-    if spot_key in ("ste_anne", "ange_gardien"):
-        return in_SW(dir_deg) and tide_state == "rising"
-    if spot_key == "st_jean":
-        return in_NE(dir_deg) and tide_state == "falling"
-    return False
+    required_tide = rule[1]
+    return dir_ok and (required_tide is None or tide_state == required_tide)
+
+# ----- Output -----
+def _write_if_changed(path, payload: str):
+    # Leave an identical file untouched (no mtime bump, nothing for deploys/browsers to refetch)
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == payload:
+                print(f"[INFO] {path} unchanged; not rewritten", file=sys.stderr)
+                return
+    except OSError:
+        pass
+    # Write beside it and swap, so a crash mid-write never leaves a truncated file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(payload)
+    os.replace(path + ".tmp", path)
+
+def write_forecast(result: dict, path="forecast.json", rows_path="forecast.ndjson"):
+    # Machine-consumed (index.html): compact separators, no indentation
+    _write_if_changed(path, json.dumps(result, ensure_ascii=False, separators=(",", ":")))
+    # Same hour rows, one compact object per line, for tools that stream row by row
+    _write_if_changed(rows_path, "".join(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                         for row in result["hours"]))
 
 # ----- MAIN -----
+def forecast_is_current(path="forecast.json") -> bool:
+    """True when path already holds a complete forecast generated for this hour (NOW)."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            prev = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (prev.get("generated_at") == NOW.isoformat() and bool(prev.get("hours"))
+            and (prev.get("tide_baseline") or {}).get("lat") is not None)
+
 def main():
+    # Same-hour reruns (the :30 cron) only redo the work if the previous output came out degraded
+    if "--force" not in sys.argv[1:] and forecast_is_current():
+        print("[INFO] forecast.json is already current for this hour; skipping (--force to rebuild)", file=sys.stderr)
+        return
     start_local = NOW
     end_local   = NOW + dt.timedelta(hours=HOURS)
+    start_date, end_date = start_local.date().isoformat(), end_local.date().isoformat()
     result = {"generated_at": NOW.isoformat(), "hours": []}
 
-    # 1) Wind per spot
-    wind = {}
-    for key, spot in SPOTS.items():
+    # 1) Wind for all spots in one multi-location request; per-spot requests only if that fails
+    def wind_series(wj):
+        return {
+            "time": wj["hourly"]["time"],                # local ISO (no tz offset)
+            "avg":  wj["hourly"]["windspeed_10m"],       # kn
+            "gust": wj["hourly"]["windgusts_10m"],       # kn
+            "dir":  wj["hourly"]["winddirection_10m"],   # deg
+        }
+
+    def fetch_all_wind():
+        try:
+            blocks = fetch_open_meteo_wind([(s["lat"], s["lon"]) for s in SPOTS.values()], start_date, end_date)
+            if len(blocks) != len(SPOTS):
+                raise ValueError(f"{len(blocks)} location blocks for {len(SPOTS)} spots")
+            return dict(zip(SPOTS, map(wind_series, blocks)))
+        except Exception as e:
+            print(f"[WARN] Combined wind fetch failed: {e}; retrying per spot", file=sys.stderr)
+            return None
+
+    def fetch_wind(key):
+        spot = SPOTS[key]
         try:
-            wj = fetch_open_meteo_wind(spot["lat"], spot["lon"], start_local, end_local)
-            wind[key] = {
-                "time": wj["hourly"]["time"],                # local ISO (no tz offset)
-                "avg":  wj["hourly"]["windspeed_10m"],       # kn
-                "gust": wj["hourly"]["windgusts_10m"],       # kn
-                "dir":  wj["hourly"]["winddirection_10m"],   # deg
-            }
+            return wind_series(fetch_open_meteo_wind([(spot["lat"], spot["lon"])], start_date, end_date)[0])
         except Exception as e:
             print(f"[WARN] Wind fetch failed for {spot['name']}: {e}", file=sys.stderr)
-            wind[key] = {"time": [], "avg": [], "gust": [], "dir": []}
+            return {"time": [], "avg": [], "gust": [], "dir": []}
+
+    # The hourly grid only depends on the requested dates, so the primary SPINE fetch can run
+    # alongside the wind request instead of waiting for it.
+    pool = ThreadPoolExecutor(max_workers=len(SPOTS) + 1)
+    candidates = baseline_candidates()  # last run's winner first
+    wind_fut = pool.submit(fetch_all_wind)
+    exp_iso = expected_utc_grid(start_local, end_local)
+    plat, plon = candidates[0]
+    primary_fut = pool.submit(spine_levels, plat, plon, exp_iso)
+    wind = wind_fut.result()
+    if wind is None:
+        wind = dict(zip(SPOTS, pool.map(fetch_wind, SPOTS)))
+    pool.shutdown(wait=False)
 
     # 2) Master timeline = Beauport wind hours
     timeline_local = wind.get("beauport", {}).get("time", [])
     if not timeline_local:
-        with open("forecast.json", "w", encoding="utf-8") as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
+        write_forecast(result)
         return
 
-    # Build UTC hour instants and hour pairs for tide classification (SPINE is UTC)
-    utc_hours, utc_pairs = [], []
-    for tloc in timeline_local:
-        t0 = parse_local_iso(tloc).astimezone(dt.timezone.utc)
-        a  = t0.isoformat().replace("+00:00","Z")
-        b  = (t0 + dt.timedelta(hours=1)).isoformat().replace("+00:00","Z")
-        utc_hours.append(a)
-        utc_pairs.append((a,b))
-
-    # 3) Pick the BEST SPINE proxy by trial coverage, then fetch full horizon
-    flat_times = [ts for p in utc_pairs for ts in p]
+    # Row of each master hour in each spot's series. All spots normally share one Open-Meteo grid,
+    # so rows line up by position (the repeated local hour at DST end keeps its own wind);
+    # a grid that doesn't line up falls back to the first row carrying that local time.
+    def row_index(times):
+        if times == timeline_local:
+            return range(len(timeline_local))
+        first = {}
+        for i, t in enumerate(times):
+            first.setdefault(t, i)
+        return [first.get(t) for t in timeline_local]
+
+    wind_rows = {key: row_index(w["time"]) for key, w in wind.items()}
+
+    # Build UTC hour instants and hour pairs for tide classification (SPINE is UTC).
+    # Open-Meteo steps are uniform in UTC, so parse only the first hour and step from there
+    # (this also keeps the repeated local hour distinct when DST ends).
+    t0_utc = parse_local_iso(timeline_local[0]).astimezone(UTC)
+    utc_dt  = [t0_utc + dt.timedelta(hours=i) for i in range(len(timeline_local) + 1)]
+    utc_iso = [t.strftime("%Y-%m-%dT%H:%M:%SZ") for t in utc_dt]  # ascending, unique
+    utc_hours = utc_iso[:-1]
+    utc_pairs = list(zip(utc_iso, utc_iso[1:]))
+
+    # 3) SPINE baseline: fetch the full horizon at the preferred candidate straight away; only when
+    #    its coverage is poor, probe the alternates on a trial window and complete the best one.
+    flat_times = utc_iso  # every pair boundary, each instant once
     trial = flat_times[:48] if len(flat_times) >= 48 else flat_times
 
-    best = None  # (ok_count, (lat,lon), test_map)
-    for (plat, plon) in BASELINE_CANDIDATES:
-        test_map = spine_levels_batch(plat, plon, trial, chunk_size=24)
-        ok_test  = sum(1 for ts in trial if ts in test_map)
-        print(f"[INFO] Baseline test @({plat},{plon}): {ok_test} OK trial points", file=sys.stderr)
-        if best is None or ok_test > best[0]:
-            best = (ok_test, (plat, plon), test_map)
+    primary_map = primary_fut.result()
+    planned = set(exp_iso)
+    unplanned = [ts for ts in flat_times if ts not in planned]
+    if unplanned:  # timeline differs from the requested dates: complete the primary map
+        primary_map = {**primary_map, **spine_levels(plat, plon, unplanned)}
+    ok_full = sum(1 for ts in flat_times if ts in primary_map)
+    print(f"[INFO] Baseline primary @({plat},{plon}): {ok_full}/{len(flat_times)} OK", file=sys.stderr)
+    best = (sum(1 for ts in trial if ts in primary_map), 0, (plat, plon), primary_map)  # (ok_trial, -rank, (lat,lon), map)
+
+    if ok_full < BASELINE_MIN_COVERAGE * len(flat_times):
+        # Alternates are probed concurrently; keep the best coverage (ties -> earlier candidate).
+        # A full-coverage hit ends the search once no earlier-ranked probe is still pending, so
+        # the choice never depends on which request finishes first.
+        pool = ThreadPoolExecutor(max_workers=len(candidates))
+        probes = {pool.submit(spine_levels, plat, plon, trial): (rank, (plat, plon))
+                  for rank, (plat, plon) in enumerate(candidates) if rank > 0}
+        pending = {rank for rank, _ in probes.values()}
+        try:
+            for fut in as_completed(probes):
+                rank, (plat, plon) = probes[fut]
+                pending.discard(rank)
+                test_map = fut.result()
+                ok_test  = sum(1 for ts in trial if ts in test_map)
+                print(f"[INFO] Baseline test @({plat},{plon}): {ok_test} OK trial points", file=sys.stderr)
+                if (ok_test, -rank) > best[:2]:
+                    best = (ok_test, -rank, (plat, plon), test_map)
+                if best[0] == len(trial) and all(r > -best[1] for r in pending):
+                    break  # only later-ranked probes remain; none of them can win a tie
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
     baseline_map = {}
     baseline_latlon = None
-    if best and best[0] >= max(6, len(trial)//6):  # relaxed: ≥6 or ≥~16% of trial
-        plat, plon = best[1]
-        print(f"[INFO] Baseline SELECTED @({plat},{plon}) — fetching full horizon", file=sys.stderr)
-        baseline_map = spine_levels_batch(plat, plon, flat_times, chunk_size=36)
+    if best[0] >= max(6, len(trial)//6):  # relaxed: ≥6 or ≥~16% of trial
+        plat, plon = best[2]
+        baseline_map = best[3]
+        if best[1] != 0:  # an alternate won: it only holds the trial window so far
+            print(f"[INFO] Baseline SELECTED @({plat},{plon}) — fetching full horizon", file=sys.stderr)
+            missing = [ts for ts in flat_times if ts not in baseline_map]
+            baseline_map = {**baseline_map, **spine_levels(plat, plon, missing)}
         baseline_latlon = (plat, plon)
+        remember_baseline(baseline_latlon)
     else:
         print("[INFO] No suitable baseline from SPINE trials; tides will be 'unknown'", file=sys.stderr)
 
     # 4) Build baseline (Beauport) tide trend per hour: exact lookup, then nearest (±150 min), then wide-edge (±12h)
+    #    Consecutive pairs share their boundary instant, so resolve each instant once, then classify.
     baseline_trend = {}
     if baseline_map:
-        times, vals = build_sorted_series(baseline_map)
-
-        def classify_pair_with_fallbacks(a_isoZ, b_isoZ):
-            v0 = baseline_map.get(a_isoZ)
-            v1 = baseline_map.get(b_isoZ)
-            if v0 is None or v1 is None:
-                t0 = dt.datetime.fromisoformat(a_isoZ.replace("Z","+00:00")).astimezone(dt.timezone.utc)
-                t1 = dt.datetime.fromisoformat(b_isoZ.replace("Z","+00:00")).astimezone(dt.timezone.utc)
-                if v0 is None: v0 = nearest_value(times, vals, t0, MAX_T_MATCH_MIN)
-                if v1 is None: v1 = nearest_value(times, vals, t1, MAX_T_MATCH_MIN)
-            if v0 is None or v1 is None:
-                t0 = dt.datetime.fromisoformat(a_isoZ.replace("Z","+00:00")).astimezone(dt.timezone.utc)
-                t1 = dt.datetime.fromisoformat(b_isoZ.replace("Z","+00:00")).astimezone(dt.timezone.utc)
-                if v0 is None: v0 = nearest_value(times, vals, t0, EDGE_MAX_MINUTES)
-                if v1 is None: v1 = nearest_value(times, vals, t1, EDGE_MAX_MINUTES)
-            if v0 is None or v1 is None:
-                return "unknown"
-            dv = v1 - v0
-            if dv > EPS_TIDE:  return "rising"
-            if dv < -EPS_TIDE: return "falling"
-            return "slack"
-
-        for (a_isoZ, b_isoZ) in utc_pairs:
-            baseline_trend[a_isoZ] = classify_pair_with_fallbacks(a_isoZ, b_isoZ)
+        level = dict(zip(utc_iso, resolve_levels(baseline_map, utc_iso, utc_dt)))
+        baseline_trend = {a: classify_trend(level[a], level[b]) for (a, b) in utc_pairs}
     else:
         print("[INFO] Baseline map empty; tides will be 'unknown'", file=sys.stderr)
 
-    # 5) Compose hour rows (fill Beauport tide here; other tides filled later)
-    rows = []
-    for i, t_loc_iso in enumerate(timeline_local):
-        row = {"time": t_loc_iso}
-        utc_iso = utc_hours[i]
-
-        for key, spot in SPOTS.items():
-            gust = avg = d = None
-            try:
-                idx = wind[key]["time"].index(t_loc_iso)
-                gust = float(wind[key]["gust"][idx]) if wind[key]["gust"][idx] is not None else None
-                avg  = float(wind[key]["avg"][idx])  if wind[key]["avg"][idx]  is not None else None
-                d    = float(wind[key]["dir"][idx])  if wind[key]["dir"][idx]  is not None else None
-            except Exception:
-                pass
-
-            tide_status = "unknown"
-            if baseline_trend and key == "beauport":
-                tide_status = baseline_trend.get(utc_iso, "unknown")
-
-            # TEMP go_flag (for Beauport only is final; for others we recompute after offsets)
-            go_flag = evaluate_go(key, gust, d, tide_status)
-
-            row[key] = {
-                "wind_kn": round(gust, 1) if gust is not None else None,
-                "wind_avg_kn": round(avg, 1) if avg is not None else None,
-                "dir_deg": round(d) if d is not None else None,
-                "tide": tide_status,
-                "go": {k: None for k in SPOTS.keys()}  # will fill below
-            }
-            row[key]["go"][key] = go_flag
-
-        rows.append(row)
-
-    result["hours"] = rows
-
-    # 6) Apply CHS-style time offsets in LOCAL time to synthesize tides for the other spots
-    apply_spot_tide_offsets(result)
-
-    # 7) RECOMPUTE go/no-go for ALL spots using the FINAL tide state in each row
-    for row in result["hours"]:
-        for key in SPOTS.keys():
-            spot = row.get(key, {})
-            gust = spot.get("wind_kn")
-            d    = spot.get("dir_deg")
-            tide = spot.get("tide", "unknown")
-            go   = evaluate_go(key, gust, d, tide)
-            # keep the same structure: only the spot's own flag is filled
-            spot["go"] = {k: None for k in SPOTS.keys()}
-            spot["go"][key] = go
-            row[key] = spot
+    # 5) Per-spot columns aligned to the master timeline (values rounded as emitted)
+    def column(key, field, ndigits):
+        vals = wind[key][field]
+        out = []
+        for j in wind_rows[key]:
+            v = vals[j] if j is not None and j < len(vals) else None
+            out.append(round(float(v), ndigits) if v is not None else None)
+        return out
+
+    cols = {key: {"wind_kn":     column(key, "gust", 1),
+                  "wind_avg_kn": column(key, "avg", 1),
+                  "dir_deg":     column(key, "dir", None)} for key in SPOTS}
+
+    # 6) Tide per spot: Beauport from the baseline trend; the others via CHS-style local-time offsets
+    base_tide = [baseline_trend.get(utc_iso, "unknown") for utc_iso in utc_hours]
+    spot_tides = shift_spot_tides(base_tide) if baseline_trend else {}  # no baseline: all 'unknown'
+    for key, c in cols.items():
+        c["tide"] = base_tide if key == "beauport" else spot_tides.get(key, ["unknown"] * len(base_tide))
+
+    # 7) Go/no-go for ALL spots using the FINAL tide state, then materialize the hour rows
+    for key, c in cols.items():
+        dir_ok = sector_mask(key, c["dir_deg"])
+        c["go"] = [evaluate_go(key, g, ok, t) for g, ok, t in zip(c["wind_kn"], dir_ok, c["tide"])]
+
+    result["hours"] = [
+        {"time": t_loc_iso, **{key: {f: col[i] for f, col in c.items()} for key, c in cols.items()}}
+        for i, t_loc_iso in enumerate(timeline_local)
+    ]
 
     # 8) Debug + metadata
-    def count_trend(rows_list, key):
-        return dict(Counter(r.get(key, {}).get("tide", "unknown") for r in rows_list))
     result["tide_baseline"] = {
         "lat": (baseline_latlon[0] if baseline_latlon else None),
         "lon": (baseline_latlon[1] if baseline_latlon else None),
@@ -347,11 +690,12 @@ def main():
         "edge_nearest_min": EDGE_MAX_MINUTES,
         "note": "Non-Baseline tides are time-shifted from Beauport using local-time offsets.",
     }
-    result["debug_counts"] = {k: count_trend(result["hours"], k) for k in SPOTS.keys()}
+    result["debug_counts"] = {k: dict(Counter(cols[k]["tide"])) for k in SPOTS.keys()}
     result["wind_models"] = "Open-Meteo auto (no models= param)"
 
-    with open("forecast.json", "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    save_level_cache()
+    prune_response_cache()
+    write_forecast(result)
 
 if __name__ == "__main__":
     main()